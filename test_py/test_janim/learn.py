@@ -19,7 +19,9 @@ class CmptAnimExample(Timeline):
     
     self.show(circle)
     self.forward()
+    # color covers both stroke and fill, so it has to finish first;
+    # fill and points are independent components and can play together
     self.play(circle.anim.color.set(GREEN))
-    self.play(circle.anim.fill.set(alpha=0.2))
-    self.play(circle.anim.points.scale(2))
+    self.play(circle.anim.fill.set(alpha=0.2),
+              circle.anim.points.scale(2))
     self.forward()
\ No newline at end of file
@@ -3,27 +3,44 @@
 import taichi as ti
 ti.init(arch=ti.gpu)
 
-@ti.func
-def is_prime(n: int):
-  result = True
-  # Traverses the range between 2 and sqrt(n)
-  # - Returns False if n can be divided by one of them;
-  # - otherwise, returns True
-  for k in range(2, int(n ** 0.5) + 1):
-    if n % k == 0:
-      result = False
-      break
-  return result
+n = 1000000
+# The range [0, n) is split into segments of this size,
+# so that the multiples of a prime are marked by many threads
+segment_size = 4096
+num_segments = (n + segment_size - 1) // segment_size
+
+# is_composite[k] is set once k is known to be a composite number
+is_composite = ti.field(ti.u1, shape=n)
+
+# Sieve of Eratosthenes
+# Every (p, segment) pair is handled by one thread, which marks
+# the multiples of p falling into that segment as composite
+@ti.kernel
+def sieve():
+  for p, s in ti.ndrange((2, int(n ** 0.5) + 1), num_segments):
+    # Skips p if it is already known to be composite:
+    # marking its multiples again would be harmless,
+    # so it does not matter if the mark is not visible yet
+    if not is_composite[p]:
+      lo = ti.max(p * p, s * segment_size)
+      hi = ti.min(n, (s + 1) * segment_size)
+      # Traverses the multiples m * p in the range [lo, hi)
+      for m in range((lo + p - 1) // p, (hi + p - 1) // p):
+        is_composite[m * p] = 1
 
 # Traverses the range between 2 and n
-# Counts the primes according to the return of is_prime()
+# Counts the numbers that are not marked by sieve()
 @ti.kernel
-def count_primes(n: int) -> int:
+def count_unmarked() -> int:
   count = 0
   for k in range(2, n):
-    if is_prime(k):
-      count += 1
-      
+    count += 1 - ti.cast(is_composite[k], ti.i32)
+
   return count
 
-print(count_primes(1000000))
\ No newline at end of file
+def count_primes() -> int:
+  is_composite.fill(0)
+  sieve()
+  return count_unmarked()
+
+print(count_primes())
\ No newline at end of file
@@ -1,6 +1,11 @@
+import math
+
 import taichi as ti
-ti.init(arch=ti.vulkan)
+ti.init(arch=ti.vulkan, default_ip=ti.i32)
 
+# n does not have to be a power of two: Taichi allocates
+# fields in packed mode (the only mode since Taichi 1.4),
+# so the n x n fields are not padded to the next power of two
 n = 128
 # The n x n grid is normalized
 # The distance between two x- or z-axis adjacent points
@@ -8,6 +13,9 @@ n = 128
 quad_size = 1.0 / n
 dt = 4e-2 / n
 substeps = int(1 / 60 // dt)
+# Number of substeps run by a single kernel launch
+# (see run_substeps())
+substeps_per_launch = 16
 
 # Gravity is a force applied in the negative direction of the y axis,
 # and so is set to [0, -9.8, 0]
@@ -21,26 +29,43 @@ spring_Y = 3e4
 dashpot_damping = 1e4
 # Damping coefficient of springs
 drag_damping = 1
+# Velocity decay caused by drag_damping over a single substep
+drag_factor = math.exp(-drag_damping * dt)
 
 
 ball_radius = 0.3
-# Use a 1D field for storing the position of the ball center
-# The only element in the field is a 3-dimentional floating-point vector
-ball_center = ti.Vector.field(3, dtype=float, shape=(1, ))
 # Place the ball center at the original point
-ball_center[0] = [0, 0, 0]
+# The position is passed to run_substeps() as a kernel argument
+ball_pos = ti.Vector([0.0, 0.0, 0.0])
+# Use a 1D field for storing the position of the ball center,
+# which is only used for rendering the ball
+# The only element in the field is a 3-dimentional floating-point vector
+ball_center = ti.Vector.field(3, dtype=ti.f32, shape=(1, ))
+ball_center[0] = ball_pos
 
 # x is an n x n field consisting of 3D floating-point vectors
 # representing the mass points' positions
-x = ti.Vector.field(3, dtype=float, shape=(n, n))
+x = ti.Vector.field(3, dtype=ti.f32)
 # v is an n x n field consisting of 3D floating-point vectors
 # representing the mass points' velocities
-v = ti.Vector.field(3, dtype=float, shape=(n, n))
+v = ti.Vector.field(3, dtype=ti.f32)
+# substep() reads the current state from x and v and writes
+# the next state into x_next and v_next, so that no mass point
+# sees a neighbor that has already been updated in the same substep.
+# The two pairs of fields swap roles after every substep
+x_next = ti.Vector.field(3, dtype=ti.f32)
+v_next = ti.Vector.field(3, dtype=ti.f32)
+# Place x and v of the same mass point next to each other (AoS),
+# since substep() always accesses them together
+ti.root.dense(ti.ij, (n, n)).place(x, v)
+ti.root.dense(ti.ij, (n, n)).place(x_next, v_next)
 
-num_triangels = (n - 1) * (n - 1) * 2
-indices = ti.field(int, shape=num_triangels * 3)
-vertices = ti.Vector.field(3, dtype=float, shape=n * n)
-colors = ti.Vector.field(3, dtype=float, shape=n * n)
+num_triangles = (n - 1) * (n - 1) * 2
+# 32-bit triangle indices, laid out densely for the renderer
+indices = ti.field(ti.i32)
+ti.root.dense(ti.i, num_triangles * 3).place(indices)
+vertices = ti.Vector.field(3, dtype=ti.f32, shape=n * n)
+colors = ti.Vector.field(3, dtype=ti.f32, shape=n * n)
 
 # bending_springs = False
 bending_springs = True
@@ -49,11 +74,12 @@ bending_springs = True
 # automatically parallelize all top-level for loops
 # inside initialize_mass_points()
 @ti.kernel
-def initialize_mass_points():
+def initialize_mass_points(x: ti.template(), v: ti.template()):
   # A random offset to apply to each mass point
   random_offset = ti.Vector([ti.random() - 0.5, ti.random() - 0.5]) * 0.1
   
   # Field x stores the mass points' positions
+  ti.loop_config(block_dim=256)
   for i, j in x:
     # The piece of cloth is 0.6 (y-axis) above the original point
     #
@@ -67,7 +93,7 @@ def initialize_mass_points():
     v[i, j] = [0, 0, 0]
     
 @ti.kernel
-def initial_mesh_indices():
+def initialize_mesh_indices():
   for i, j in ti.ndrange(n - 1, n - 1):
     quad_id = (i * (n - 1)) + j
     # First triangle of the square
@@ -85,92 +111,148 @@ def initial_mesh_indices():
     else:
       colors[i * n + j] = (1, 0.334, 0.52)
       
-initial_mesh_indices()
+initialize_mesh_indices()
 
 # The cloth is modeled as a mass-spring grid. Assume that:
 # a mass point, whose relative index is [0, 0],
 # can be affected by at most 12 surrounding points
 #
-# spring_offsets is such a list storing
+# spring_offsets is such a tuple storing
 # the relative indices of these 'influential' points
-spring_offsets = []
+#
+# It is built completely before substep() is compiled
+# and frozen, so ti.static() always unrolls every spring
+#
+# The offsets are plain (di, dj) integer pairs, which
+# substep() adds to the index of the current mass point
 if bending_springs:
-  for i in range(-1, 2):
-    for j in range(-1, 2):
-      if (i, j) != (0, 0):
-        spring_offsets.append(ti.Vector([i, j]))
+  spring_offsets = tuple(
+    (i, j) for i in range(-1, 2) for j in range(-1, 2) if (i, j) != (0, 0)
+  )
 else:
-  for i in range(-2, 3):
-    for j in range(-2, 3):
-      if (i, j) != (0, 0) and abs(i) + abs(j) <= 2:
-        spring_offsets.append(ti.Vector([i, j]))
+  spring_offsets = tuple(
+    (i, j) for i in range(-2, 3) for j in range(-2, 3)
+    if (i, j) != (0, 0) and abs(i) + abs(j) <= 2
+  )
+
+# The rest length of each spring only depends on its offset,
+# so it is worked out once here instead of inside substep()
+spring_rest_lengths = tuple(
+  quad_size * math.hypot(di, dj) for di, dj in spring_offsets
+)
 
 # substep() works out the *accumulative* effects
 # of gravity, internal force, damping, and collision
 # on the mass-spring system
-@ti.kernel
-def substep():
-  # The for loop iterates over all elements of the field v
-  for i in ti.grouped(x):
-    v[i] += gravity * dt
-  
-  # The for loop iterates over all elements of the field v
-  
+#
+# All the effects are applied in a single pass so that
+# x[i] and v[i] are loaded only once per substep
+#
+# In the last substep of a frame, write_vertices is set
+# and the new positions are also copied into the vertices
+# used for rendering
+@ti.func
+def substep(x, v, x_next, v_next, ball_pos, write_vertices):
   # Traverses the field x as a 1D array
   #
   # The `i` here refers to the *absolute* index
   # of an element in the field x
   #
   # Note that `i` is a 2-dimentional vector here   
+  #
+  # 256 threads per block keeps the GPU well occupied
+  # despite the registers used by the unrolled spring loop
+  # (128 and 512 are the other sizes worth trying)
+  ti.loop_config(block_dim=256)
   for i in ti.grouped(x):
+    xi = x[i]
+    vi = v[i]
     # Initial force exerted to a specific mass point
     force = ti.Vector([0.0, 0.0, 0.0])
     # Traverse the surrounding mass points
-    for spring_offset in ti.static(spring_offsets):
-      # j is the *absolute* index of an 'influential' point
-      # Note that j is a 2-dimensional vector here
-      j = i + spring_offset
-      #  If the 'influential` point is in the n x n grid,
-      # then work out the internal force that it exerts
-      # on the current mass point
-      if 0 <= j[0] < n and 0 <= j[1] < n:
-        # The relative displacement of the two points
-        # The internal force is related to it
-        x_ij = x[i] - x[j]
-        # The relative movement of the two points
-        v_ij = v[i] - v[j]
-        # d is a normalized vector (its norm is 1)
-        d = x_ij.normalized()
-        current_dist = x_ij.norm()
-        original_dist = quad_size * float(i - j).norm()
-        # Internal force of the spring
-        force += -spring_Y * d * (current_dist / original_dist - 1)
-        # Continues to apply the damping force
-        # from the relative movement
-        # of the two points
-        force += -v_ij.dot(d) * d * dashpot_damping * quad_size
+    for k in ti.static(range(len(spring_offsets))):
+      di, dj = ti.static(spring_offsets[k])
+      original_dist = ti.static(spring_rest_lengths[k])
+      # [jx, jy] is the *absolute* index of an 'influential' point
+      jx = i[0] + di
+      jy = i[1] + dj
+      # Only an 'influential' point inside the n x n grid
+      # exerts internal force on the current mass point.
+      #
+      # Instead of branching on it, every thread reads the
+      # nearest point inside the grid and multiplies its force
+      # by 0 if the 'influential' point is out of the grid
+      valid = (jx >= 0) & (jx < n) & (jy >= 0) & (jy < n)
+      jx = ti.max(ti.min(jx, n - 1), 0)
+      jy = ti.max(ti.min(jy, n - 1), 0)
+      # The relative displacement of the two points
+      # The internal force is related to it
+      x_ij = xi - x[jx, jy]
+      # The relative movement of the two points
+      # (gravity changes both velocities equally,
+      # so it does not affect v_ij)
+      v_ij = vi - v[jx, jy]
+      # d is a normalized vector (its norm is 1)
+      # Both d and current_dist are worked out
+      # from a single reciprocal square root
+      #
+      # The clamped j may be i itself, so len_sq is kept
+      # away from 0 to keep the masked-out force finite
+      len_sq = x_ij.dot(x_ij)
+      inv_len = ti.rsqrt(ti.max(len_sq, 1e-12))
+      d = x_ij * inv_len
+      current_dist = len_sq * inv_len
+      # Internal force of the spring
+      f = -spring_Y * d * (current_dist / original_dist - 1)
+      # Continues to apply the damping force
+      # from the relative movement
+      # of the two points
+      f += -v_ij.dot(d) * d * dashpot_damping * quad_size
+      force += ti.select(valid, 1.0, 0.0) * f
         
-    # Continues to add the velocity caused by the internal forces
+    # Adds the velocity caused by gravity and the internal forces
     # to the current velocity
-    v[i] += force * dt 
+    vi += gravity * dt
+    vi += force * dt
     
-  # Traverse the elements in field v
-  for i in ti.grouped(x):
-    v[i] *= ti.exp(-drag_damping * dt)
-    offset_to_center = x[i] - ball_center[0]
+    vi *= drag_factor
+    offset_to_center = xi - ball_pos
     if offset_to_center.norm() <= ball_radius:
       # velocity projection
       normal = offset_to_center.normalized()
-      v[i] -= min(v[i].dot(normal), 0) * normal
+      vi -= min(vi.dot(normal), 0) * normal
       
-    # After working out the accumulative v[i],
+    # After working out the accumulative vi,
     # work out the positions of each mass point
-    x[i] += dt * v[i]
-    
+    xi += dt * vi
+    x_next[i] = xi
+    v_next[i] = vi
+    if write_vertices != 0:
+      vertices[i[0] * n + i[1]] = xi
+
+# run_substeps() advances the mass-spring system by `steps`
+# substeps within a single kernel launch
+#
+# ti.static() unrolls the loop at compile time, so every substep
+# is still a top-level for loop that Taichi parallelizes, and
+# the substeps run one after another
+#
+# The two pairs of fields swap roles after every substep, so after
+# an odd number of substeps the latest state is in x_next and v_next
+#
+# Only the last substep writes the vertices, if write_vertices is set
 @ti.kernel
-def update_vertices():
-  for i, j in ti.ndrange(n, n):
-    vertices[i * n + j] = x[i, j]
+def run_substeps(x: ti.template(), v: ti.template(),
+                 x_next: ti.template(), v_next: ti.template(),
+                 steps: ti.template(), write_vertices: ti.i32,
+                 ball_pos: ti.types.vector(3, ti.f32)):
+  ti.static_assert(steps >= 1)
+  for s in ti.static(range(steps)):
+    last = ti.static(int(s == steps - 1))
+    if ti.static(s % 2 == 0):
+      substep(x, v, x_next, v_next, ball_pos, write_vertices * last)
+    else:
+      substep(x_next, v_next, x, v, ball_pos, write_vertices * last)
     
 
 window = ti.ui.Window("Taichi Cloth Simulation on GGUI", (1024, 1024),
@@ -179,24 +261,29 @@ canvas = window.get_canvas()
 canvas.set_background_color((1, 1, 1))
 scene = ti.ui.Scene()
 camera = ti.ui.Camera()
+# The camera never moves, so it is set up once
+camera.position(0.0, 0.0, 3)
+camera.lookat(0.0, 0.0, 0)
+scene.set_camera(camera)
 
 current_t = 0.0
-initialize_mass_points()
+initialize_mass_points(x, v)
 
 while window.running:
   if current_t > 1.5:
     # Reset
-    initialize_mass_points()
+    initialize_mass_points(x, v)
     current_t = 0
     
-  for i in range(substeps):
-    substep()
-    current_t += dt
-  update_vertices()
-  
-  camera.position(0.0, 0.0, 3)
-  camera.lookat(0.0, 0.0, 0)
-  scene.set_camera(camera)
+  # Runs the substeps in chunks of substeps_per_launch,
+  # only the last launch of a frame writes the vertices
+  for first in range(0, substeps, substeps_per_launch):
+    steps = min(substeps_per_launch, substeps - first)
+    run_substeps(x, v, x_next, v_next, steps,
+                 first + steps == substeps, ball_pos)
+    if steps % 2 == 1:
+      x, v, x_next, v_next = x_next, v_next, x, v
+  current_t += dt * substeps
   
   scene.point_light(pos=(0, 1, 2), color=(1, 1, 1))
   scene.ambient_light((0.5, 0.5, 0.5))
@@ -1,42 +1,59 @@
+import math
+
 import taichi as ti
 import numpy as np
 
-ti.init(arch=ti.vulkan if ti._lib.core.with_vulkan() else ti.cuda)
+ti.init(arch=ti.vulkan if ti._lib.core.with_vulkan() else ti.cuda, default_ip=ti.i32)
 
 # 全局参数
+# Taichi 1.4 起 field 总是以 packed 模式分配，n 不必是 2 的幂
 n = 128
 quad_size = 1.0 / n
 dt = 2e-2 / n
 substeps = int(1 / 60 // dt)
+# 每次 kernel 启动运行的 substep 数
+substeps_per_launch = 16
 
 gravity = ti.Vector([0, -9.8, 0])
 spring_Y = 3e4
 dashpot_damping = 1e4
 drag_damping = 1
+drag_factor = math.exp(-drag_damping * dt)
 
 ball_radius = 0.3
-ball_center = ti.Vector.field(3, dtype=float, shape=(1,))
-ball_center[0] = [0, 0, 0]
+ball_pos = ti.Vector([0.0, 0.0, 0.0])
+# 仅用于渲染小球，substep 通过 kernel 参数获取球心
+ball_center = ti.Vector.field(3, dtype=ti.f32, shape=(1,))
+ball_center[0] = ball_pos
 
-x = ti.Vector.field(3, dtype=float, shape=(n, n))
-v = ti.Vector.field(3, dtype=float, shape=(n, n))
+x = ti.Vector.field(3, dtype=ti.f32)
+v = ti.Vector.field(3, dtype=ti.f32)
+# 双缓冲：substep 从 x, v 读取，写入 x_next, v_next，之后两组交换
+x_next = ti.Vector.field(3, dtype=ti.f32)
+v_next = ti.Vector.field(3, dtype=ti.f32)
+# 同一质点的 x 和 v 相邻存放 (AoS)
+ti.root.dense(ti.ij, (n, n)).place(x, v)
+ti.root.dense(ti.ij, (n, n)).place(x_next, v_next)
 
 num_triangles = (n - 1) * (n - 1) * 2
-indices = ti.field(int, shape=num_triangles * 3)
-vertices = ti.Vector.field(3, dtype=float, shape=n * n)
-colors = ti.Vector.field(3, dtype=float, shape=n * n)
+indices = ti.field(ti.i32)
+ti.root.dense(ti.i, num_triangles * 3).place(indices)
+vertices = ti.Vector.field(3, dtype=ti.f32, shape=n * n)
+colors = ti.Vector.field(3, dtype=ti.f32, shape=n * n)
 
 bending_springs = False
-spring_offsets = []
 
-# 拖拽状态变量
-dragging = ti.field(ti.u1, shape=())
-picked_node = ti.Vector.field(2, dtype=ti.i32, shape=())
-drag_pos = ti.Vector.field(3, dtype=float, shape=())
+# 拾取状态变量
+pick_radius = 0.02
+picked_dist = ti.field(ti.f32, shape=())
+# 第一遍算出的各点到射线的距离，第二遍直接比较，不再重新计算
+ray_dist = ti.field(ti.f32, shape=(n, n))
+picked_idx = ti.field(ti.i32, shape=())
 
 @ti.kernel
-def initialize_mass_points():
+def initialize_mass_points(x: ti.template(), v: ti.template()):
     random_offset = ti.Vector([ti.random() - 0.5, ti.random() - 0.5]) * 0.1
+    ti.loop_config(block_dim=256)
     for i, j in x:
         x[i, j] = [
             i * quad_size - 0.5 + random_offset[0],
@@ -64,65 +81,103 @@ def initialize_mesh_indices():
         else:
             colors[i * n + j] = (1, 0.334, 0.52)
 
-def initialize_spring_offsets():
-    if bending_springs:
-        for i in range(-1, 2):
-            for j in range(-1, 2):
-                if (i, j) != (0, 0):
-                    spring_offsets.append(ti.Vector([i, j]))
-    else:
-        for i in range(-2, 3):
-            for j in range(-2, 3):
-                if (i, j) != (0, 0) and abs(i) + abs(j) <= 2:
-                    spring_offsets.append(ti.Vector([i, j]))
-
-@ti.kernel
-def substep():
-    for i in ti.grouped(x):
-        v[i] += gravity * dt
+# 弹簧偏移在 substep 编译前就已确定，ti.static 总能完整展开
+if bending_springs:
+    spring_offsets = tuple(
+        (i, j) for i in range(-1, 2) for j in range(-1, 2) if (i, j) != (0, 0)
+    )
+else:
+    spring_offsets = tuple(
+        (i, j) for i in range(-2, 3) for j in range(-2, 3)
+        if (i, j) != (0, 0) and abs(i) + abs(j) <= 2
+    )
+spring_rest_lengths = tuple(quad_size * math.hypot(di, dj) for di, dj in spring_offsets)
 
+@ti.func
+def substep(x, v, x_next, v_next, dragging, pi, pj, drag_pos, ball_pos,
+            write_vertices):
+    # 每个 block 256 个线程（也可试 128 / 512）
+    ti.loop_config(block_dim=256)
     for i in ti.grouped(x):
+        xi = x[i]
+        vi = v[i]
         force = ti.Vector([0.0, 0.0, 0.0])
-        for spring_offset in ti.static(spring_offsets):
-            j = i + spring_offset
-            if 0 <= j[0] < n and 0 <= j[1] < n:
-                x_ij = x[i] - x[j]
-                v_ij = v[i] - v[j]
-                d = x_ij.normalized()
-                current_dist = x_ij.norm()
-                original_dist = quad_size * float(i - j).norm()
-                force += -spring_Y * d * (current_dist / original_dist - 1)
-                force += -v_ij.dot(d) * d * dashpot_damping * quad_size
-        v[i] += force * dt
+        for k in ti.static(range(len(spring_offsets))):
+            di, dj = ti.static(spring_offsets[k])
+            original_dist = ti.static(spring_rest_lengths[k])
+            jx = i[0] + di
+            jy = i[1] + dj
+            # 不用分支判断越界：读取夹紧到网格内的点，越界时力乘 0
+            valid = (jx >= 0) & (jx < n) & (jy >= 0) & (jy < n)
+            jx = ti.max(ti.min(jx, n - 1), 0)
+            jy = ti.max(ti.min(jy, n - 1), 0)
+            x_ij = xi - x[jx, jy]
+            v_ij = vi - v[jx, jy]
+            len_sq = x_ij.dot(x_ij)
+            # 夹紧后 j 可能等于 i，避免 rsqrt(0)
+            inv_len = ti.rsqrt(ti.max(len_sq, 1e-12))
+            d = x_ij * inv_len
+            current_dist = len_sq * inv_len
+            f = -spring_Y * d * (current_dist / original_dist - 1)
+            f += -v_ij.dot(d) * d * dashpot_damping * quad_size
+            force += ti.select(valid, 1.0, 0.0) * f
+        vi += gravity * dt
+        vi += force * dt
 
-    for i in ti.grouped(x):
-        v[i] *= ti.exp(-drag_damping * dt)
+        vi *= drag_factor
 
-        # 拖拽覆盖原速度
-        if dragging[None] == 1 and all(i == picked_node[None]):
-            v[i] = (drag_pos[None] - x[i]) / dt * 0.5
+        # 拖拽覆盖原速度（无分支：只有被拖拽的点 mask 为 1）
+        drag_v = (drag_pos - xi) / dt * 0.5
+        mask = ti.select((i[0] == pi) & (i[1] == pj) & (dragging != 0), 1.0, 0.0)
+        vi += mask * (drag_v - vi)
 
-        offset_to_center = x[i] - ball_center[0]
+        offset_to_center = xi - ball_pos
         if offset_to_center.norm() <= ball_radius:
             normal = offset_to_center.normalized()
-            v[i] -= ti.min(v[i].dot(normal), 0) * normal
+            vi -= ti.min(vi.dot(normal), 0) * normal
 
-        x[i] += dt * v[i]
-    for i in range(n):
-        x[i, n - 1] = [i * quad_size - 0.5, 0.6, 0.5]
-        v[i, n - 1] = [0, 0, 0]
+        xi += dt * vi
+
+        # 固定最后一列
+        if i[1] == n - 1:
+            xi = ti.Vector([i[0] * quad_size - 0.5, 0.6, 0.5])
+            vi = ti.Vector([0.0, 0.0, 0.0])
+
+        x_next[i] = xi
+        v_next[i] = vi
+        # 每帧最后一个 substep 顺便更新渲染用的顶点
+        if write_vertices != 0:
+            vertices[i[0] * n + i[1]] = xi
+
+# 一次 kernel 启动内完成 steps 个 substep
+# ti.static 在编译期展开循环，每个 substep 仍是并行的顶层 for 循环
+# 两组缓冲每个 substep 交换一次，steps 为奇数时最新状态在 x_next, v_next
+# 只有最后一个 substep 在 write_vertices 为真时写入顶点
+# 拖拽状态和球心作为 kernel 参数传入，不再从全局 field 读取
 @ti.kernel
-def update_vertices():
-    for i, j in ti.ndrange(n, n):
-        vertices[i * n + j] = x[i, j]
+def run_substeps(x: ti.template(), v: ti.template(),
+                 x_next: ti.template(), v_next: ti.template(),
+                 steps: ti.template(), write_vertices: ti.i32,
+                 dragging: ti.i32, pi: ti.i32, pj: ti.i32,
+                 drag_pos: ti.types.vector(3, ti.f32),
+                 ball_pos: ti.types.vector(3, ti.f32)):
+    ti.static_assert(steps >= 1)
+    for s in ti.static(range(steps)):
+        last = ti.static(int(s == steps - 1))
+        if ti.static(s % 2 == 0):
+            substep(x, v, x_next, v_next, dragging, pi, pj, drag_pos, ball_pos,
+                    write_vertices * last)
+        else:
+            substep(x_next, v_next, x, v, dragging, pi, pj, drag_pos, ball_pos,
+                    write_vertices * last)
 
-def get_mouse_ray(camera, screen_pos, width, height):
-    import numpy as np
+def get_inv_view_proj(camera, width, height):
     view_mat = np.array(camera.get_view_matrix()).reshape(4, 4)
     aspect = width / height
     proj_mat = np.array(camera.get_projection_matrix(aspect)).reshape(4, 4)
-    inv_vp = np.linalg.inv(proj_mat @ view_mat)
+    return np.linalg.inv(proj_mat @ view_mat)
 
+def get_mouse_ray(inv_vp, screen_pos):
     ndc_x = screen_pos[0] * 2.0 - 1.0
     ndc_y = 1.0 - screen_pos[1] * 2.0
     near = np.array([ndc_x, ndc_y, -1.0, 1.0])
@@ -138,20 +193,32 @@ def get_mouse_ray(camera, screen_pos, width, height):
     ray_dir /= np.linalg.norm(ray_dir)
     return ray_origin, ray_dir
 
-def pick_node(ray_ori, ray_dir):
-    min_dist = 1e10
-    node = None
-    for i in range(n):
-        for j in range(n):
-            pos = x.to_numpy()[i, j]
-            to_node = pos - ray_ori
-            t = np.dot(to_node, ray_dir)
-            closest = ray_ori + t * ray_dir
-            dist = np.linalg.norm(closest - pos)
-            if dist < 0.02 and dist < min_dist:
-                node = (i, j)
-                min_dist = dist
-    return node
+@ti.func
+def distance_to_ray(p, ray_ori, ray_dir):
+    closest = ray_ori + (p - ray_ori).dot(ray_dir) * ray_dir
+    return (closest - p).norm()
+
+@ti.kernel
+def pick_kernel(x: ti.template(), ray_ori: ti.types.vector(3, ti.f32),
+                ray_dir: ti.types.vector(3, ti.f32)):
+    picked_dist[None] = pick_radius
+    picked_idx[None] = n * n
+    # 先并行求最小距离，再找出距离等于最小值的编号最小的点
+    for i, j in x:
+        dist = distance_to_ray(x[i, j], ray_ori, ray_dir)
+        ray_dist[i, j] = dist
+        ti.atomic_min(picked_dist[None], dist)
+    for i, j in x:
+        dist = ray_dist[i, j]
+        if dist < pick_radius and dist == picked_dist[None]:
+            ti.atomic_min(picked_idx[None], i * n + j)
+
+def pick_node(x, ray_ori, ray_dir):
+    pick_kernel(x, ti.Vector(ray_ori), ti.Vector(ray_dir))
+    idx = picked_idx[None]
+    if idx == n * n:
+        return None
+    return divmod(idx, n)
 
 def main():
     window = ti.ui.Window("Cloth Simulation with Drag", (768, 768), vsync=True)
@@ -159,35 +226,49 @@ def main():
     canvas.set_background_color((1, 1, 1))
     scene = window.get_scene()
     camera = ti.ui.Camera()
+    # 相机固定不动，只需设置一次
+    camera.position(0.0, 0.0, 3)
+    camera.lookat(0.0, 0.0, 0)
+    scene.set_camera(camera)
+    # 相机固定，逆视图投影矩阵也只需计算一次
+    inv_vp = get_inv_view_proj(camera, 768, 768)
 
     initialize_mesh_indices()
-    initialize_mass_points()
-    initialize_spring_offsets()
+    initialize_mass_points(x, v)
+
+    # 当前状态与下一状态
+    state, state_next = (x, v), (x_next, v_next)
+
+    # 拖拽状态
+    dragging = 0
+    picked_node = (0, 0)
+    drag_pos = (0.0, 0.0, 0.0)
 
     while window.running:
-        for _ in range(substeps):
-            substep()
-        update_vertices()
+        # 按 substeps_per_launch 分批运行，只有每帧最后一次启动写入顶点
+        for first in range(0, substeps, substeps_per_launch):
+            steps = min(substeps_per_launch, substeps - first)
+            run_substeps(*state, *state_next, steps, first + steps == substeps,
+                         dragging, *picked_node, ti.Vector(drag_pos), ball_pos)
+            if steps % 2 == 1:
+                state, state_next = state_next, state
 
         # 处理鼠标交互
         if window.is_pressed(ti.ui.LMB):
             mpos = window.get_cursor_pos()
-            ray_ori, ray_dir = get_mouse_ray(camera, mpos, 768, 768)
-            if dragging[None] == 0:
-                picked = pick_node(ray_ori, ray_dir)
+            ray_ori, ray_dir = get_mouse_ray(inv_vp, mpos)
+            if dragging == 0:
+                picked = pick_node(state[0], ray_ori, ray_dir)
                 if picked:
-                    picked_node[None] = picked
-                    dragging[None] = 1
+                    picked_node = picked
+                    dragging = 1
             else:
                 # 更新拖拽目标位置
-                drag_pos[None] = ray_ori + ray_dir * 1.5
+                drag_pos = ray_ori + ray_dir * 1.5
         else:
-            dragging[None] = 0
+            dragging = 0
 
-        # 设置相机和绘图
-        camera.position(0.0, 0.0, 3)
-        camera.lookat(0.0, 0.0, 0)
-        scene.set_camera(camera)
+        # 绘图
         scene.ambient_light((0.5, 0.5, 0.5))
         scene.point_light(pos=(0, 1, 2), color=(1, 1, 1))
         scene.mesh(vertices, indices=indices, per_vertex_color=colors, two_sided=True)